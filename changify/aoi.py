@@ -0,0 +1,192 @@
+"""
+Area of interest masks for pruning work
+
+An area of interest is either a path to a raster mask on the ARD grid, where
+non-zero pixels are in, or polygon rings given as sequences of projected
+(x, y) vertices. Rings are combined with the even-odd rule, so holes and
+multiple polygons can be given as extra rings. Rings that are used for many
+chips should be converted with polygons first, so the vertex arrays and the
+extent are only worked out once.
+"""
+import logging
+from typing import NamedTuple, Union, Sequence, Tuple, List
+
+import numpy as np
+
+from changify import ard
+
+
+log = logging.getLogger(__name__)
+
+
+class Polygons(NamedTuple):
+    """
+    Polygon rings as vertex arrays, along with their bounding extent.
+    """
+    rings: List[np.ndarray]
+    extent: ard.GeoExtent
+
+
+AOI = Union[str, Polygons, Sequence[Sequence[Tuple[ard.Num, ard.Num]]]]
+
+
+def israster(aoi: AOI) -> bool:
+    return isinstance(aoi, str)
+
+
+def polygons(aoi: AOI) -> AOI:
+    """
+    Convert polygon rings into Polygons, anything else is returned as is.
+    """
+    if israster(aoi) or isinstance(aoi, Polygons):
+        return aoi
+
+    rings = [np.asarray(ring, dtype=float) for ring in aoi]
+
+    return Polygons(rings, aoiextent(rings))
+
+
+def aoiextent(aoi: AOI) -> ard.GeoExtent:
+    """
+    Bounding extent of the area of interest.
+    """
+    if israster(aoi):
+        return ard.raster_extent(aoi)
+
+    if isinstance(aoi, Polygons):
+        return aoi.extent
+
+    verts = np.concatenate([np.asarray(ring, dtype=float) for ring in aoi])
+
+    return ard.GeoExtent(xmin=verts[:, 0].min(), ymax=verts[:, 1].max(),
+                         xmax=verts[:, 0].max(), ymin=verts[:, 1].min())
+
+
+def intersects(ext1: ard.GeoExtent, ext2: ard.GeoExtent) -> bool:
+    """
+    Whether two extents overlap, touching edges do not count.
+    """
+    return (ext1.xmin < ext2.xmax and ext2.xmin < ext1.xmax and
+            ext1.ymin < ext2.ymax and ext2.ymin < ext1.ymax)
+
+
+def inpolygon(xs: np.ndarray, ys: np.ndarray, rings: Sequence) -> np.ndarray:
+    """
+    Even-odd point in polygon test, vectorized over the points.
+
+    Crossings are counted to the left of each point, so only the edges whose
+    y-range takes in some of the points and that start left of the rightmost
+    point can change the answer, the rest are skipped.
+
+    Args:
+        xs: projected x coordinates
+        ys: projected y coordinates
+        rings: polygon rings of (x, y) vertices
+
+    Returns:
+        boolean ndarray shaped like xs
+    """
+    inside = np.zeros(np.shape(xs), dtype=bool)
+
+    if not inside.size:
+        return inside
+
+    xmax, ymin, ymax = np.max(xs), np.min(ys), np.max(ys)
+
+    for ring in rings:
+        verts = np.asarray(ring, dtype=float)
+        nexts = np.roll(verts, -1, axis=0)
+
+        lo = np.minimum(verts[:, 1], nexts[:, 1])
+        hi = np.maximum(verts[:, 1], nexts[:, 1])
+        keep = (lo < hi) & (lo <= ymax) & (hi > ymin) & (np.minimum(verts[:, 0], nexts[:, 0]) < xmax)
+
+        for (x1, y1), (x2, y2) in zip(verts[keep], nexts[keep]):
+            crosses = (y1 > ys) != (y2 > ys)
+            xint = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (xint < xs)
+
+    return inside
+
+
+def chipextent(coord: ard.GeoCoordinate, shape: Tuple[int, int]=(100, 100)) -> ard.GeoExtent:
+    return ard.GeoExtent(coord.x, coord.y, coord.x + shape[1] * 30, coord.y - shape[0] * 30)
+
+
+def rastermask(path: str, ext: ard.GeoExtent, shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Read a mask raster over an extent, anything beyond the raster is out.
+    """
+    bounds = ard.raster_extent(path)
+    inter = ard.GeoExtent(max(ext.xmin, bounds.xmin), min(ext.ymax, bounds.ymax),
+                          min(ext.xmax, bounds.xmax), max(ext.ymin, bounds.ymin))
+
+    arr = ard.extract_geoextent(path, inter)
+    row = int((ext.ymax - inter.ymax) // 30)
+    col = int((inter.xmin - ext.xmin) // 30)
+
+    ret = np.zeros(shape, dtype=bool)
+    ret[row:row + arr.shape[0], col:col + arr.shape[1]] = arr != 0
+
+    return ret
+
+
+def chipmask(coord: ard.GeoCoordinate, aoi: AOI, shape: Tuple[int, int]=(100, 100)) -> np.ndarray:
+    """
+    Which pixels of a chip fall inside the area of interest.
+
+    Args:
+        coord (sequence): chip upper left
+        aoi: raster mask path, polygon rings or Polygons
+        shape: (rows, columns) of the chip
+
+    Returns:
+        2-d boolean ndarray
+    """
+    coord = ard.GeoCoordinate(*coord)
+    ext = chipextent(coord, shape)
+
+    if not intersects(ext, aoiextent(aoi)):
+        return np.zeros(shape, dtype=bool)
+
+    if israster(aoi):
+        return rastermask(aoi, ext, shape)
+
+    # Test the pixel centers
+    xs = coord.x + 15 + 30 * np.arange(shape[1])
+    ys = coord.y - 15 - 30 * np.arange(shape[0])
+    xs, ys = np.meshgrid(xs, ys)
+
+    return inpolygon(xs, ys, aoi.rings if isinstance(aoi, Polygons) else aoi)
+
+
+def prunetiles(tiles: Sequence[Tuple[int, int]], aoi: AOI, params: dict) -> List[Tuple[int, int]]:
+    """
+    Drop the (h, v) tiles whose extent misses the area of interest.
+    """
+    bounds = aoiextent(polygons(aoi))
+
+    return [(h, v) for h, v in tiles
+            if intersects(ard.ard_hv(h, v, params['region-extent'])[0], bounds)]
+
+
+def prunechips(chips: Sequence[Tuple[ard.Num, ard.Num]], aoi: AOI,
+               shape: Tuple[int, int]=(100, 100)) -> List[ard.GeoCoordinate]:
+    """
+    Drop the chips that have no pixels inside the area of interest, before
+    anything about them gets listed or read.
+
+    Args:
+        chips: sequence of chip upper lefts
+        aoi: raster mask path or polygon rings
+        shape: (rows, columns) of the chips
+
+    Returns:
+        list of GeoCoordinate
+    """
+    aoi = polygons(aoi)
+    ret = [ard.GeoCoordinate(*c) for c in chips if chipmask(c, aoi, shape).any()]
+
+    log.debug('Kept %s of %s chips inside the area of interest', len(ret), len(chips))
+
+    return ret
@@ -2,14 +2,18 @@
 ARD related functionality
 """
 import os
-from functools import partial, lru_cache
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from itertools import chain
-from typing import Union, NamedTuple, Tuple
+from typing import Union, NamedTuple, Tuple, Sequence, List
 import logging
 
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 import numpy as np
 
+from changify import cache
+
 
 log = logging.getLogger(__name__)
 
@@ -69,23 +73,127 @@ class ARDattributes(NamedTuple):
     contents: str
 
 
-def timeseries(x: Num, y: Num, params: dict):
-    pass
+def timeseries(x: Num, y: Num, params: dict) -> dict:
+    """
+    Full time series for a single pixel.
+
+    Args:
+        x: projected x coordinate
+        y: projected y coordinate
+        params: processing parameters
+
+    Returns:
+        dict of 1-d arrays, keyed by layer, plus 'dates'
+    """
+    return pointseries([(x, y)], params)[0]
 
 
-def timechips(x: Num, y: Num, params: dict):
+def pointseries(points: Sequence[Tuple[Num, Num]], params: dict) -> list:
+    """
+    Time series for many pixels at once.
+
+    Points are grouped by tile, then each layer within each acquisition is
+    opened once and only the windows that cover the requested pixels are read,
+    so a single pass over a tile's tarballs serves every point in it.
+
+    Args:
+        points: sequence of (x, y) coordinate pairs
+        params: processing parameters
+
+    Returns:
+        list of dicts of 1-d arrays, keyed by layer, plus 'dates', in the
+        same order as the points
+    """
+    coords = [GeoCoordinate(*p) for p in points]
+
+    tiles = defaultdict(list)
+    for idx, coord in enumerate(coords):
+        tiles[determine_hv(coord, params['region-tileaff'])].append(idx)
+
+    ret = [None] * len(coords)
+    for (h, v), idxs in tiles.items():
+        log.debug('Building time series for %s points in h%02dv%02d', len(idxs), h, v)
+
+        _, affine = ard_hv(h, v, params['region-extent'])
+        hvroot = tileroot(coords[idxs[0]], params)
+        files = tilefiles(hvroot, params)
+        layers = layersdict(files, hvroot, params)
+
+        rcs = [transform_geo(coords[i], affine) for i in idxs]
+        windows = pointwindows(rcs, params['point-window-ratio'])
+
+        series = {layer: np.array([readpoints(path, rcs, windows) for path in layers[layer]])
+                  for layer in layers}
+        dates = np.array(filedates(files['refl_files']))
+
+        for col, idx in enumerate(idxs):
+            ret[idx] = {layer: series[layer][:, col] for layer in series}
+            ret[idx]['dates'] = dates
+
+    return ret
+
+
+def timechips(x: Num, y: Num, params: dict, shape: Tuple[int, int]=(100, 100)):
     log.debug('Building chips for %s %s', x, y)
     coord = GeoCoordinate(x, y)
+
+    hvroot = tileroot(coord, params)
+    filesdict = tilefiles(hvroot, params)
+
+    return buildchips(coord, hvroot, filesdict, params, shape)
+
+
+def tileroot(coord: GeoCoordinate, params: dict) -> str:
+    """
+    Directory holding the ARD tarballs for the tile that contains the coordinate.
+
+    Args:
+        coord (sequence): (x, y) coordinate pair
+        params: processing parameters
+
+    Returns:
+        string path
+    """
     h, v = determine_hv(coord, params['region-tileaff'])
 
-    hvroot = os.path.join(params['file-root'], 'h{:02d}v{:02d}'.format(h, v))
+    return os.path.join(params['file-root'], 'h{:02d}v{:02d}'.format(h, v))
+
+
+def tilefiles(hvroot: str, params: dict) -> dict:
+    """
+    Reflectance and thermal tarball listings for a tile directory.
+
+    Args:
+        hvroot: ARD h##v## tile directory
+        params: processing parameters
+
+    Returns:
+        dict
+    """
+    return {'refl_files': tarfiles(hvroot, params['acquired'], params['region'], params['refl']),
+            'therm_files': tarfiles(hvroot, params['acquired'], params['region'], 'BT')}
 
-    filesdict = {'refl_files': tarfiles(hvroot, params['acquired'], params['region'], params['refl']),
-                 'therm_files': tarfiles(hvroot, params['acquired'], params['region'], 'BT')}
 
-    layers = layersdict(filesdict, hvroot, params)
+def buildchips(coord: GeoCoordinate, hvroot: str, files: dict, params: dict,
+               shape: Tuple[int, int]=(100, 100)) -> dict:
+    """
+    Extract the chip stacks for the given tarball listings, along with the
+    acquisition dates (YYYYMMDD) they correspond to.
+
+    Args:
+        coord (sequence): (x, y) coordinate pair
+        hvroot: ARD h##v## tile directory
+        files: tarball listings, as from tilefiles
+        params: processing parameters
+        shape: (rows, columns) of the chip
+
+    Returns:
+        dict
+    """
+    layers = layersdict(files, hvroot, params)
 
-    chips = layerstochips(coord, layers, params)
+    chips = layerstochips(coord, layers, params, shape)
+    chips['dates'] = np.array(filedates(files['refl_files']))
 
     return chips
 
@@ -111,19 +219,68 @@ def layersdict(files: dict, root, params: dict):
     return ret
 
 
-def layerstochips(coord, layers, params):
+def layerstochips(coord, layers, params, shape=(100, 100)):
     h, v = determine_hv(coord, params['region-tileaff'])
     _, affine = ard_hv(h, v, params['region-extent'])
 
+    threads = params.get('threads', 1)
+    if threads > 1:
+        return threadedchips(coord, layers, affine, shape, threads)
+
     ret = {}
     for layer in layers:
-        ret[layer] = np.array([extract_chip(path, coord, affine)
+        ret[layer] = np.array([extract_chip(path, coord, affine, shape)
                                for path in layers[layer]])
 
     return ret
 
 
-@lru_cache(maxsize=3000)
+def threadedchips(coord: GeoCoordinate, layers: dict, affine: tuple, shape: Tuple[int, int],
+                  threads: int) -> dict:
+    """
+    Threaded counterpart to the serial extraction in layerstochips.
+
+    GDAL releases the GIL while decompressing and reading, so several reads
+    can be in flight at once. Each extraction opens its own dataset handles,
+    nothing GDAL related is shared between threads, and every read lands in
+    its slice of a preallocated stack. The output matches serial extraction.
+
+    Args:
+        coord (sequence): (x, y) coordinate pair
+        layers: layer name -> list of VSI paths, as from layersdict
+        affine: 30m affine for the tile
+        shape: (rows, columns) of the chip
+        threads: number of reader threads
+
+    Returns:
+        dict
+    """
+    ret = {}
+    for layer, paths in layers.items():
+        if not paths:
+            ret[layer] = np.array([])
+            continue
+
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+            open_raster(paths[0]).GetRasterBand(1).DataType)
+        ret[layer] = np.empty((len(paths),) + tuple(shape), dtype=dtype)
+
+    def read(task):
+        layer, idx, path = task
+        ret[layer][idx] = extract_chip(path, coord, affine, shape)
+
+    tasks = [(layer, idx, path)
+             for layer, paths in layers.items()
+             for idx, path in enumerate(paths)]
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # Drain the iterator so any read errors get raised here
+        list(pool.map(read, tasks))
+
+    return ret
+
+
+@cache.cached('filenameattr')
 def filenameattr(filename: str) -> ARDattributes:
     """
     Provide a centralized function for deriving pertinent information from a given filename.
@@ -175,10 +332,11 @@ def vsipath(tarpath: str, band: str, specs: dict, refl: str) -> str:
     return '/vsitar/' + path
 
 
-@lru_cache(maxsize=72)
+@cache.cached('tarfiles', weigher=cache.listbytes)
 def tarfiles(path: str, acquired: str, region: str, tar: str) -> list:
     """
-    Provide a listing of all tarballs that meet the requirements for processing.
+    Provide a listing of all tarballs that meet the requirements for processing,
+    ordered by acquisition date.
 
     Args:
         path: ARD h##v## tile directory
@@ -191,10 +349,11 @@ def tarfiles(path: str, acquired: str, region: str, tar: str) -> list:
     """
     fs = filters(acquired, region, tar)
 
-    return [x for x in dirlisting(path) if all(f(x) for f in fs)]
+    return sorted((x for x in dirlisting(path) if all(f(x) for f in fs)),
+                  key=lambda x: filenameattr(x).acqdate)
 
 
-@lru_cache(maxsize=3)
+@cache.cached('filters')
 def filters(acquired: str, region: str, tar: str) -> list:
     """
     Sets up the filters when scanning through the ARD data directories.
@@ -212,7 +371,7 @@ def filters(acquired: str, region: str, tar: str) -> list:
             partial(filter_reg, region=region)]
 
 
-@lru_cache(maxsize=9)
+@cache.cached('dirlisting', weigher=cache.listbytes)
 def dirlisting(path: str) -> list:
     """
     Helper function around os.listdir for caching.
@@ -524,7 +683,78 @@ def extract_rcextent(path: str, rc_extent: RowColumnExtent, band: int=1):
                                               lr.row - ul.row)
 
 
-@lru_cache()
+def pointwindows(rcs: Sequence[RowColumn], ratio: Num) -> List[Tuple[RowColumnExtent, list]]:
+    """
+    Work out the minimal set of read windows that cover the given pixels.
+
+    Pixels are grouped by the 100x100 block they fall in. A group is read with
+    a single window around its members when that window holds no more than
+    ratio pixels per member, otherwise each member gets a 1x1 read.
+
+    Args:
+        rcs: row/column pixel locations
+        ratio: pixels read allowed per requested pixel for a merged window
+
+    Returns:
+        list of (RowColumnExtent, indices into rcs) pairs
+
+    Examples:
+        >>> pointwindows([RowColumn(0, 0), RowColumn(1, 1)], 4)
+        [(RowColumnExtent(st_row=0, st_col=0, end_row=2, end_col=2), [0, 1])]
+    """
+    blocks = defaultdict(list)
+    for idx, rc in enumerate(rcs):
+        blocks[(rc.row // 100, rc.column // 100)].append(idx)
+
+    ret = []
+    for idxs in blocks.values():
+        rows = [rcs[i].row for i in idxs]
+        cols = [rcs[i].column for i in idxs]
+        ext = RowColumnExtent(min(rows), min(cols), max(rows) + 1, max(cols) + 1)
+
+        if (ext.end_row - ext.st_row) * (ext.end_col - ext.st_col) <= ratio * len(idxs):
+            ret.append((ext, idxs))
+        else:
+            ret.extend((RowColumnExtent(rcs[i].row, rcs[i].column,
+                                        rcs[i].row + 1, rcs[i].column + 1), [i])
+                       for i in idxs)
+
+    return ret
+
+
+def readpoints(path: str, rcs: Sequence[RowColumn], windows: list, band: int=1) -> np.ndarray:
+    """
+    Read the values for a set of pixels from a raster, opening it only once.
+
+    Args:
+        path: raster path
+        rcs: row/column pixel locations
+        windows: read windows, as from pointwindows
+        band: raster band
+
+    Returns:
+        1-d ndarray, in the same order as rcs
+    """
+    ds = open_raster(path)
+    rb = ds.GetRasterBand(band)
+
+    ret = None
+    for ext, idxs in windows:
+        arr = rb.ReadAsArray(ext.st_col,
+                             ext.st_row,
+                             ext.end_col - ext.st_col,
+                             ext.end_row - ext.st_row)
+
+        if ret is None:
+            ret = np.empty(len(rcs), dtype=arr.dtype)
+
+        for i in idxs:
+            ret[i] = arr[rcs[i].row - ext.st_row, rcs[i].column - ext.st_col]
+
+    return ret
+
+
+@cache.cached('chipul')
 def chipul(coord: GeoCoordinate, chip_aff: tuple) -> GeoCoordinate:
     """
     Chip defined as a 100x100 30m pixel area.
@@ -541,7 +771,7 @@ def chipul(coord: GeoCoordinate, chip_aff: tuple) -> GeoCoordinate:
     return transform_rc(rc, chip_aff)
 
 
-def extract_chip(path: str, coord: GeoCoordinate, chip_aff: tuple):
+def extract_chip(path: str, coord: GeoCoordinate, chip_aff: tuple, shape: Tuple[int, int]=(100, 100)):
     """
     Chip defined as a 100x100 30m pixel area.
 
@@ -549,12 +779,13 @@ def extract_chip(path: str, coord: GeoCoordinate, chip_aff: tuple):
         path:
         coord (sequence): (x, y) coordinate pair
         chip_aff: special affine that determines the bounds of data extraction and processing
+        shape: (rows, columns) to extract, smaller for sub-chips
 
     Returns:
 
     """
     chip_ul = chipul(coord, chip_aff)
-    chip_ext = GeoExtent(chip_ul[0], chip_ul[1], chip_ul[0] + 3000, chip_ul[1] - 3000)
+    chip_ext = GeoExtent(chip_ul[0], chip_ul[1], chip_ul[0] + shape[1] * 30, chip_ul[1] - shape[0] * 30)
 
     log.debug('Extracting chip %s from layer %s', chip_ext, path)
 
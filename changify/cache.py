@@ -0,0 +1,186 @@
+"""
+Central registry for the lookup caches used across the package
+
+Cache bounds come from the 'caches' section of config.yaml, and can be
+overridden through the environment, e.g. CHANGIFY_CACHE_TARFILES_MAXSIZE or
+CHANGIFY_CACHE_TARFILES_MAXBYTES. Caches holding lists can also be bounded
+by their approximate size in memory, not just by entry count.
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+from functools import wraps
+from typing import NamedTuple, Callable, Iterable
+
+from changify import app
+
+
+class CacheStats(NamedTuple):
+    """
+    Snapshot of a cache's bounds and usage.
+    """
+    name: str
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    nbytes: int
+    maxsize: int
+    maxbytes: int
+
+
+class LRUCache:
+    """
+    Thread safe least-recently-used cache, bounded by entry count and,
+    when given a weigher, by the total weight of the held values.
+    """
+    def __init__(self, name: str, maxsize: int=None, maxbytes: int=None, weigher: Callable=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.weigher = weigher
+
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.nbytes = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value) -> None:
+        weight = self.weigher(value) if self.weigher else 0
+
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+
+            self._data[key] = (value, weight)
+            self.nbytes += weight
+            self._evict()
+
+    def resize(self, maxsize: int=None, maxbytes: int=None) -> None:
+        with self._lock:
+            self.maxsize = maxsize
+            self.maxbytes = maxbytes
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self.name, self.hits, self.misses, self.evictions,
+                              len(self._data), self.nbytes, self.maxsize, self.maxbytes)
+
+    def _evict(self) -> None:
+        # Always hang on to the most recent entry
+        while len(self._data) > 1 and self._overbounds():
+            _, (_, weight) = self._data.popitem(last=False)
+            self.nbytes -= weight
+            self.evictions += 1
+
+    def _overbounds(self) -> bool:
+        return ((self.maxsize is not None and len(self._data) > self.maxsize) or
+                (self.maxbytes is not None and self.nbytes > self.maxbytes))
+
+
+_registry = {}
+
+
+def listbytes(value: list) -> int:
+    """
+    Approximate memory held by a list and its items.
+    """
+    return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value)
+
+
+def bounds(name: str) -> tuple:
+    """
+    Configured (maxsize, maxbytes) for a cache, environment first then
+    config.yaml. None means unbounded.
+    """
+    conf = app.Config.get('caches', {}).get(name, {})
+
+    ret = []
+    for key in ('maxsize', 'maxbytes'):
+        val = os.environ.get('CHANGIFY_CACHE_{}_{}'.format(name.upper(), key.upper()), conf.get(key))
+        ret.append(int(val) if val is not None else None)
+
+    return tuple(ret)
+
+
+def cached(name: str, weigher: Callable=None):
+    """
+    Decorator that memoizes a function through a named cache in the registry.
+
+    The wrapped function keeps the cache_clear and cache_info methods that
+    functools.lru_cache provides.
+
+    Args:
+        name: registry name, also used to look up the bounds
+        weigher: function giving the weight in bytes of a cached value
+
+    Returns:
+        decorator
+    """
+    def cached_dec(func):
+        maxsize, maxbytes = bounds(name)
+        store = _registry[name] = LRUCache(name, maxsize, maxbytes, weigher)
+        missing = object()
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = args + tuple(sorted(kwargs.items()))
+
+            ret = store.get(key, missing)
+            if ret is missing:
+                ret = func(*args, **kwargs)
+                store.put(key, ret)
+
+            return ret
+
+        wrapper.cache_clear = store.clear
+        wrapper.cache_info = store.stats
+
+        return wrapper
+    return cached_dec
+
+
+def registry() -> dict:
+    return dict(_registry)
+
+
+def stats() -> dict:
+    """
+    Hits, misses, evictions and usage for every registered cache.
+
+    Returns:
+        dict of name -> CacheStats
+    """
+    return {name: c.stats() for name, c in _registry.items()}
+
+
+def clear(names: Iterable[str]=None) -> None:
+    """
+    Empty the named caches, or all of them, for instance between tiles.
+    Statistics are kept.
+    """
+    for name in (names if names is not None else _registry):
+        _registry[name].clear()
+
+
+def resize(name: str, maxsize: int=None, maxbytes: int=None) -> None:
+    """
+    Change a cache's bounds at run time, evicting as needed.
+    """
+    _registry[name].resize(maxsize, maxbytes)
@@ -1,8 +1,59 @@
 """
 Actually run pyccd
 """
+import datetime as dt
+
+import numpy as np
 import ccd
 
 
+# Order in which pyccd expects the layers
+LAYERS = ('blues', 'greens', 'reds', 'nirs', 'swir1s', 'swir2s', 'thermals', 'qas')
+
+
 def run_ccd(dates, blues, greens, reds, nirs, swir1s, swir2s, thermals, qas):
     return ccd.detect(dates, blues, greens, reds, nirs, swir1s, swir2s, thermals, qas)
+
+
+def ordinals(dates) -> np.ndarray:
+    """
+    Convert YYYYMMDD acquisition dates into the ordinal days pyccd works with.
+
+    Args:
+        dates: sequence of YYYYMMDD integers
+
+    Returns:
+        1-d ndarray
+    """
+    return np.array([dt.datetime.strptime(str(d), '%Y%m%d').toordinal()
+                     for d in dates])
+
+
+def chipccd(chips: dict, mask: np.ndarray=None, results: list=None) -> list:
+    """
+    Run pyccd over the pixels of a chip stack.
+
+    Results are kept in row-major order, one entry per pixel. When a mask is
+    given only the pixels flagged True are run, every other pixel keeps
+    whatever it had in results (or None).
+
+    Args:
+        chips: chip stacks, as from ard.timechips
+        mask: 2-d boolean array of the pixels to run
+        results: previous per-pixel results to update
+
+    Returns:
+        list
+    """
+    dates = ordinals(chips['dates'])
+    rows, cols = chips['qas'].shape[1:]
+
+    if mask is None:
+        mask = np.ones((rows, cols), dtype=bool)
+
+    ret = list(results) if results is not None else [None] * (rows * cols)
+
+    for row, col in zip(*np.nonzero(mask)):
+        ret[row * cols + col] = run_ccd(dates, *(chips[l][:, row, col] for l in LAYERS))
+
+    return ret
@@ -0,0 +1,317 @@
+"""
+Incremental updates as new acquisitions arrive
+
+Chip stacks and pyccd results are kept on disk under the 'state-root'
+directory, one directory per chip. Each update stores only the acquisitions
+it extracted as a new segment file, named for the last acquisition date it
+holds, and segments are concatenated when the stack is read back. Once a
+chip has more than 'segment-limit' segments they are merged into one. An
+update only extracts the tarballs acquired after the last stored date, and
+re-runs pyccd for the pixels that picked up usable observations.
+
+Files are written to a temporary name and moved into place, so an
+interrupted write never leaves a truncated file behind. A merged segment
+replaces the newest one, and a segment that reaches back before the one
+ahead of it supersedes everything ahead of it, so an interrupted merge
+doesn't leave acquisitions in twice.
+"""
+import os
+import glob
+import pickle
+import logging
+import tempfile
+from typing import Tuple, Callable
+
+import numpy as np
+
+from changify import ard, cache, detect
+
+
+log = logging.getLogger(__name__)
+
+
+def chipkey(coord: ard.GeoCoordinate, params: dict) -> str:
+    """
+    Name that identifies a chip's stored state, built from the tile and the
+    chip's upper left.
+
+    Args:
+        coord (sequence): (x, y) coordinate pair
+        params: processing parameters
+
+    Returns:
+        str
+    """
+    h, v = ard.determine_hv(coord, params['region-tileaff'])
+    _, affine = ard.ard_hv(h, v, params['region-extent'])
+    ul = ard.chipul(coord, affine)
+
+    return 'h{:02d}v{:02d}_{}_{}'.format(h, v, int(ul.x), int(ul.y))
+
+
+def statedir(coord: ard.GeoCoordinate, params: dict) -> str:
+    return os.path.join(params['state-root'], chipkey(coord, params))
+
+
+def atomicwrite(path: str, write: Callable) -> None:
+    """
+    Write a file through a temporary file in the same directory, then move it
+    into place.
+
+    Args:
+        path: final file path
+        write: called with the open binary file object
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def segments(coord: ard.GeoCoordinate, params: dict) -> list:
+    """
+    Stored chip stack segments, oldest first.
+    """
+    return sorted(glob.glob(os.path.join(statedir(coord, params), 'chips_*.npz')))
+
+
+def storeddate(coord: ard.GeoCoordinate, params: dict) -> int:
+    """
+    Most recent acquisition date (YYYYMMDD) stored for a chip, 0 if none,
+    taken from the segment names so nothing has to be loaded.
+    """
+    segs = segments(coord, params)
+
+    if not segs:
+        return 0
+
+    return int(os.path.basename(segs[-1])[6:-4])
+
+
+def loadchips(coord: ard.GeoCoordinate, params: dict) -> dict:
+    """
+    Stored chip stacks, or None if nothing has been stored for the chip yet.
+    """
+    stacks = []
+    for path in segments(coord, params):
+        with np.load(path) as data:
+            stack = {k: data[k] for k in data.files}
+
+        # Left over from an interrupted merge, superseded by this segment
+        if stacks and len(stack['dates']) and stack['dates'][0] <= lastdate(stacks[-1]):
+            stacks = []
+
+        stacks.append(stack)
+
+    if not stacks:
+        return None
+
+    return {k: np.concatenate([s[k] for s in stacks]) for k in stacks[0]}
+
+
+def savechips(coord: ard.GeoCoordinate, new: dict, params: dict) -> None:
+    """
+    Store newly extracted chip stacks as a segment of their own, merging the
+    segments once there are more than 'segment-limit' of them.
+    """
+    os.makedirs(statedir(coord, params), exist_ok=True)
+    path = os.path.join(statedir(coord, params), 'chips_{}.npz'.format(lastdate(new)))
+
+    atomicwrite(path, lambda f: np.savez(f, **new))
+
+    if len(segments(coord, params)) > params['segment-limit']:
+        compact(coord, params)
+
+
+def compact(coord: ard.GeoCoordinate, params: dict) -> None:
+    """
+    Merge a chip's stored segments into one, written over the newest segment
+    before the older ones are removed.
+    """
+    segs = segments(coord, params)
+    if len(segs) < 2:
+        return
+
+    log.debug('Merging %s segments for %s', len(segs), chipkey(coord, params))
+
+    chips = loadchips(coord, params)
+    atomicwrite(segs[-1], lambda f: np.savez(f, **chips))
+
+    for path in segs[:-1]:
+        os.remove(path)
+
+
+def loadresults(coord: ard.GeoCoordinate, params: dict) -> list:
+    """
+    Stored pyccd results, or None if nothing has been stored for the chip yet.
+    """
+    path = os.path.join(statedir(coord, params), 'results.pkl')
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def saveresults(coord: ard.GeoCoordinate, results: list, params: dict) -> None:
+    os.makedirs(statedir(coord, params), exist_ok=True)
+
+    atomicwrite(os.path.join(statedir(coord, params), 'results.pkl'),
+                lambda f: pickle.dump(results, f))
+
+
+def lastdate(chips: dict) -> int:
+    """
+    Most recent acquisition date (YYYYMMDD) held in a chip stack, 0 if empty.
+    """
+    if chips is None or not len(chips['dates']):
+        return 0
+
+    return int(np.max(chips['dates']))
+
+
+def newfiles(files: dict, since: int) -> dict:
+    """
+    Reduce the tarball listings down to those acquired after the given date.
+
+    Args:
+        files: tarball listings, as from ard.tilefiles
+        since: YYYYMMDD date
+
+    Returns:
+        dict
+    """
+    return {k: [f for f in v if ard.filenameattr(f).acqdate > since]
+            for k, v in files.items()}
+
+
+def appendchips(chips: dict, new: dict) -> dict:
+    """
+    Append newly extracted chip stacks onto the stored ones, along time.
+    """
+    return {k: np.concatenate([chips[k], new[k]]) for k in chips}
+
+
+def combine(stored: dict, new: dict) -> dict:
+    """
+    Full chip stacks from the stored and new ones, either of which may be None.
+    """
+    if stored is None or new is None:
+        return new if stored is None else stored
+
+    return appendchips(stored, new)
+
+
+def affected(new: dict, params: dict) -> np.ndarray:
+    """
+    Determine which pixels need pyccd re-run.
+
+    Only usable observations (clear or water, per 'qa-usable-bits') feed
+    pyccd's models, so a pixel whose new acquisitions are all fill or cloud
+    has a last segment that is unchanged.
+
+    Args:
+        new: chip stacks holding only the new acquisitions
+        params: processing parameters
+
+    Returns:
+        2-d boolean ndarray
+    """
+    qas = new['qas']
+    bits = sum(1 << b for b in params['qa-usable-bits'])
+
+    return np.any(qas & bits, axis=0)
+
+
+def newchips(x: ard.Num, y: ard.Num, params: dict) -> dict:
+    """
+    Extract only the acquisitions newer than what is already stored for a
+    chip.
+
+    Args:
+        x: projected x coordinate
+        y: projected y coordinate
+        params: processing parameters
+
+    Returns:
+        chip stacks for the new acquisitions, None if there were none
+    """
+    coord = ard.GeoCoordinate(x, y)
+    hvroot = ard.tileroot(coord, params)
+
+    fresh = newfiles(ard.tilefiles(hvroot, params), storeddate(coord, params))
+
+    if not fresh['refl_files']:
+        log.debug('No new acquisitions for %s %s', x, y)
+        return None
+
+    log.debug('Extracting %s new acquisitions for %s %s', len(fresh['refl_files']), x, y)
+
+    return ard.buildchips(coord, hvroot, fresh, params)
+
+
+def updatechips(x: ard.Num, y: ard.Num, params: dict) -> Tuple[dict, dict]:
+    """
+    Bring a chip's stacks up to date, extracting only the acquisitions newer
+    than what is already stored.
+
+    Args:
+        x: projected x coordinate
+        y: projected y coordinate
+        params: processing parameters
+
+    Returns:
+        full chip stacks, and the stacks for only the new acquisitions
+        (None if there were none)
+    """
+    new = newchips(x, y, params)
+
+    return combine(loadchips(ard.GeoCoordinate(x, y), params), new), new
+
+
+def update(x: ard.Num, y: ard.Num, params: dict) -> list:
+    """
+    Incrementally update the stored stacks and pyccd results for a chip.
+
+    When nothing new has arrived the stored stacks are never loaded. Only the
+    new acquisitions get written out, and results are written before them, so
+    an interrupted update gets picked up again on the next run.
+
+    The cached tarball and directory listings are dropped first, so a long
+    running updater sees tarballs that arrived since it last looked.
+
+    Args:
+        x: projected x coordinate
+        y: projected y coordinate
+        params: processing parameters
+
+    Returns:
+        list of per-pixel pyccd results, row-major
+    """
+    cache.clear(['tarfiles', 'dirlisting'])
+
+    coord = ard.GeoCoordinate(x, y)
+
+    results = loadresults(coord, params)
+    new = newchips(x, y, params)
+
+    if new is None and results is not None:
+        return results
+
+    chips = combine(loadchips(coord, params), new)
+    if chips is None:
+        return []
+
+    mask = affected(new, params) if results is not None else None
+    results = detect.chipccd(chips, mask, results)
+
+    saveresults(coord, results, params)
+    if new is not None:
+        savechips(coord, new, params)
+
+    return results
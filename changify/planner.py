@@ -0,0 +1,191 @@
+"""
+Plan the order chips are processed in
+
+Chips are laid out on the ARD chip grid (100x100 30m pixels, 50x50 chips per
+tile). Each tile is finished before the next one starts, and within a tile,
+and between tiles, chips follow a space filling curve so neighbors get
+processed close together, which keeps the directory listing, dataset and
+block caches warm.
+"""
+from itertools import groupby
+from typing import Sequence, Tuple, List, Iterable
+
+from changify import ard
+
+
+# Chips along each side of a tile
+TILE_CHIPS = 50
+
+
+def hilbert(n: int, x: int, y: int) -> int:
+    """
+    Distance along a Hilbert curve filling an n x n grid, n a power of 2.
+
+    Examples:
+        >>> [hilbert(2, x, y) for x, y in [(0, 0), (0, 1), (1, 1), (1, 0)]]
+        [0, 1, 2, 3]
+    """
+    d = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+
+        s //= 2
+
+    return d
+
+
+def zorder(n: int, x: int, y: int) -> int:
+    """
+    Distance along a Z-order (Morton) curve, bits of x and y interleaved.
+
+    Examples:
+        >>> [zorder(2, x, y) for x, y in [(0, 0), (1, 0), (0, 1), (1, 1)]]
+        [0, 1, 2, 3]
+    """
+    d = 0
+    for bit in range(max(n - 1, 1).bit_length()):
+        d |= ((x >> bit) & 1) << (2 * bit)
+        d |= ((y >> bit) & 1) << (2 * bit + 1)
+
+    return d
+
+
+CURVES = {'hilbert': hilbert,
+          'zorder': zorder}
+
+
+def gridsize(length: int) -> int:
+    """
+    Smallest power of 2 that covers the given length.
+    """
+    return 1 << max(length - 1, 0).bit_length()
+
+
+def tilegrid(params: dict) -> int:
+    """
+    Curve grid size that covers the region's tiles.
+    """
+    extent = params['region-extent']
+
+    return gridsize(int(max(extent.xmax - extent.xmin, extent.ymax - extent.ymin) // 150000) + 1)
+
+
+def chiprc(coord: ard.GeoCoordinate, params: dict) -> ard.RowColumn:
+    """
+    Row/column of the chip containing the coordinate, on the region's chip grid.
+    """
+    return ard.transform_geo(coord, params['region-chipaff'])
+
+
+def chipcoord(rc: ard.RowColumn, params: dict) -> ard.GeoCoordinate:
+    """
+    Upper left of the chip at the row/column on the region's chip grid.
+    """
+    return ard.transform_rc(rc, params['region-chipaff'])
+
+
+def tilechips(h: int, v: int, params: dict) -> List[ard.GeoCoordinate]:
+    """
+    Upper lefts of every chip in an ARD tile.
+    """
+    return [chipcoord(ard.RowColumn(v * TILE_CHIPS + row, h * TILE_CHIPS + col), params)
+            for row in range(TILE_CHIPS)
+            for col in range(TILE_CHIPS)]
+
+
+def regionchips(extent: ard.GeoExtent, params: dict) -> List[ard.GeoCoordinate]:
+    """
+    Upper lefts of every chip that intersects a projected extent.
+    """
+    # Pull the lower right in a meter so chips only touching the edge are left out
+    ul = chiprc(ard.GeoCoordinate(extent.xmin, extent.ymax), params)
+    lr = chiprc(ard.GeoCoordinate(extent.xmax - 1, extent.ymin + 1), params)
+
+    return [chipcoord(ard.RowColumn(row, col), params)
+            for row in range(ul.row, lr.row + 1)
+            for col in range(ul.column, lr.column + 1)]
+
+
+def pointchips(points: Iterable[Tuple[ard.Num, ard.Num]], params: dict) -> List[ard.GeoCoordinate]:
+    """
+    Upper lefts of the distinct chips that contain the points.
+    """
+    rcs = {chiprc(ard.GeoCoordinate(*p), params) for p in points}
+
+    return [chipcoord(rc, params) for rc in rcs]
+
+
+def chipkey(coord: ard.GeoCoordinate, params: dict, curve: str='hilbert') -> tuple:
+    """
+    Sort key for a chip, the tile's position along the curve over the tile
+    grid, then the chip's position along the curve within the tile.
+    """
+    func = CURVES[curve]
+    rc = chiprc(coord, params)
+
+    v, row = divmod(rc.row, TILE_CHIPS)
+    h, col = divmod(rc.column, TILE_CHIPS)
+
+    return (func(tilegrid(params), h, v),
+            func(gridsize(TILE_CHIPS), col, row))
+
+
+def order(chips: Sequence[Tuple[ard.Num, ard.Num]], params: dict,
+          curve: str='hilbert') -> List[ard.GeoCoordinate]:
+    """
+    Order chips so that each tile is finished before the next begins, with
+    chips following a space filling curve within each tile.
+
+    Args:
+        chips: sequence of (x, y) chip coordinates, as from tilechips,
+            regionchips or pointchips
+        params: processing parameters
+        curve: 'hilbert' or 'zorder'
+
+    Returns:
+        list of GeoCoordinate
+    """
+    coords = [ard.GeoCoordinate(*c) for c in chips]
+
+    return sorted(coords, key=lambda c: chipkey(c, params, curve))
+
+
+def runs(chips: Sequence[ard.GeoCoordinate], workers: int) -> List[list]:
+    """
+    Cut an ordered chip sequence into contiguous runs, one per worker, of
+    as close to equal length as possible.
+
+    Examples:
+        >>> runs([1, 2, 3, 4, 5], 2)
+        [[1, 2, 3], [4, 5]]
+    """
+    size, extra = divmod(len(chips), workers)
+
+    ret = []
+    start = 0
+    for idx in range(workers):
+        end = start + size + (1 if idx < extra else 0)
+        ret.append(list(chips[start:end]))
+        start = end
+
+    return ret
+
+
+def tilevisits(chips: Sequence[ard.GeoCoordinate], params: dict) -> int:
+    """
+    Number of times processing moves onto a tile, a tile revisited later
+    counts again. An ordered sequence visits each tile once.
+    """
+    tiles = (ard.determine_hv(c, params['region-tileaff']) for c in chips)
+
+    return sum(1 for _ in groupby(tiles))
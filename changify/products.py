@@ -0,0 +1,225 @@
+"""
+Build change map rasters from pyccd results
+
+Per-chip results are flattened into (pixel, segment) arrays once, then every
+annual layer is derived with whole-chip NumPy operations. Output GeoTIFFs sit
+on the ARD tile grid and are written a chip at a time, so a full tile never
+has to be held in memory.
+"""
+import os
+import datetime as dt
+import logging
+from typing import Iterable, Sequence, Tuple
+
+from osgeo import gdal, osr
+import numpy as np
+
+from changify import ard
+
+
+log = logging.getLogger(__name__)
+
+# Bands combined into the change magnitude
+MAG_BANDS = ('green', 'red', 'nir', 'swir1', 'swir2')
+
+# Product name -> GDAL data type
+PRODUCTS = {'changeday': gdal.GDT_UInt16,
+            'changemag': gdal.GDT_Float32,
+            'segcount': gdal.GDT_Byte,
+            'modelqa': gdal.GDT_Byte}
+
+# Product name -> NoData value, for pixels with no pyccd result
+NODATA = {'changeday': 65535,
+          'changemag': -9999,
+          'segcount': 255,
+          'modelqa': 255}
+
+# Blocks line up with the 100x100 chip grid, 4x4 chips each, so a chip never
+# straddles a block and a compressed block isn't rewritten by its neighbors
+CREATE_OPTS = ['TILED=YES',
+               'BLOCKXSIZE=400',
+               'BLOCKYSIZE=400',
+               'COMPRESS=DEFLATE',
+               'NUM_THREADS=ALL_CPUS',
+               # Blocks never written, e.g. chips outside the AOI, read as NoData
+               'SPARSE_OK=TRUE']
+
+
+def flatten(results: Sequence[dict]) -> dict:
+    """
+    Pull the segment attributes out of per-pixel pyccd results into 2-d
+    (pixel, segment) arrays, padded out to the most segments any pixel has.
+
+    Args:
+        results: per-pixel pyccd results, None for pixels that were not run
+
+    Returns:
+        dict of 2-d ndarrays, 'valid' flags the real segments, along with
+        'ran', a 1-d array flagging the pixels that have a result
+    """
+    models = [r['change_models'] if r else [] for r in results]
+    shape = (len(models), max([len(m) for m in models] + [1]))
+
+    ret = {'start': np.zeros(shape, dtype=np.int64),
+           'end': np.zeros(shape, dtype=np.int64),
+           'break': np.zeros(shape, dtype=np.int64),
+           'prob': np.zeros(shape, dtype=np.float32),
+           'qa': np.zeros(shape, dtype=np.uint8),
+           'mag': np.zeros(shape, dtype=np.float32),
+           'valid': np.zeros(shape, dtype=bool),
+           'ran': np.array([r is not None for r in results], dtype=bool)}
+
+    for pix, segs in enumerate(models):
+        for idx, seg in enumerate(segs):
+            ret['start'][pix, idx] = seg['start_day']
+            ret['end'][pix, idx] = seg['end_day']
+            ret['break'][pix, idx] = seg['break_day']
+            ret['prob'][pix, idx] = seg['change_probability']
+            ret['qa'][pix, idx] = seg['curve_qa']
+            ret['mag'][pix, idx] = np.sqrt(sum(seg[b]['magnitude'] ** 2 for b in MAG_BANDS))
+            ret['valid'][pix, idx] = True
+
+    return ret
+
+
+def yearlayers(segs: dict, year: int, shape: Tuple[int, int]) -> dict:
+    """
+    Derive the annual product layers for a chip.
+
+    changeday: day of year of the last confirmed break in the year, 0 if none
+    changemag: magnitude of that break
+    segcount: number of segments that overlap the year
+    modelqa: curve QA of the segment in place on July 1st
+
+    Pixels without a result, not run or outside the AOI, get the product's
+    NoData value.
+
+    Args:
+        segs: flattened segments, as from flatten
+        year: calendar year
+        shape: (rows, columns) of the chip
+
+    Returns:
+        dict of 2-d ndarrays, keyed by product
+    """
+    ystart = dt.date(year, 1, 1).toordinal()
+    yend = dt.date(year, 12, 31).toordinal()
+    mid = dt.date(year, 7, 1).toordinal()
+
+    valid = segs['valid']
+    brk = segs['break']
+
+    ischange = valid & (segs['prob'] == 1) & (brk >= ystart) & (brk <= yend)
+    last = np.argmax(np.where(ischange, brk, -1), axis=1)[:, None]
+    anychange = ischange.any(axis=1)
+
+    changeday = np.where(anychange, np.take_along_axis(brk, last, axis=1)[:, 0] - ystart + 1, 0)
+    changemag = np.where(anychange, np.take_along_axis(segs['mag'], last, axis=1)[:, 0], 0)
+
+    segcount = (valid & (segs['start'] <= yend) & (segs['end'] >= ystart)).sum(axis=1)
+
+    inplace = valid & (segs['start'] <= mid) & (segs['end'] >= mid)
+    modelqa = np.where(inplace, segs['qa'], 0).max(axis=1)
+
+    layers = {'changeday': changeday.astype(np.uint16),
+              'changemag': changemag.astype(np.float32),
+              'segcount': segcount.astype(np.uint8),
+              'modelqa': modelqa.astype(np.uint8)}
+
+    return {product: np.where(segs['ran'], arr, NODATA[product]).astype(arr.dtype).reshape(shape)
+            for product, arr in layers.items()}
+
+
+def productpath(outdir: str, product: str, h: int, v: int, year: int) -> str:
+    return os.path.join(outdir, '{}_h{:02d}v{:02d}_{}.tif'.format(product, h, v, year))
+
+
+def create_raster(path: str, affine: tuple, proj4: str, datatype: int, nodata: ard.Num):
+    """
+    Create an empty, tiled and compressed single band GeoTIFF covering an ARD
+    tile.
+
+    Args:
+        path: output file path
+        affine: 30m affine for the tile
+        proj4: projection definition
+        datatype: GDAL data type
+        nodata: NoData value for the band
+
+    Returns:
+        GDAL dataset
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4(proj4)
+
+    ds = gdal.GetDriverByName('GTiff').Create(path, 5000, 5000, 1, datatype, options=CREATE_OPTS)
+    ds.SetGeoTransform(affine)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).SetNoDataValue(nodata)
+
+    return ds
+
+
+def write_chip(ds, arr: np.ndarray, rowcol: ard.RowColumn) -> None:
+    """
+    Write a chip's array into a tile raster, clipping anything that falls
+    outside of the tile.
+    """
+    rows, cols = arr.shape
+    st_row, st_col = max(rowcol.row, 0), max(rowcol.column, 0)
+    end_row = min(rowcol.row + rows, ds.RasterYSize)
+    end_col = min(rowcol.column + cols, ds.RasterXSize)
+
+    if st_row >= end_row or st_col >= end_col:
+        return
+
+    ds.GetRasterBand(1).WriteArray(arr[st_row - rowcol.row:end_row - rowcol.row,
+                                       st_col - rowcol.column:end_col - rowcol.column],
+                                   st_col, st_row)
+
+
+def tileproducts(h: int, v: int, chips: Iterable[tuple], years: Sequence[int],
+                 outdir: str, params: dict) -> list:
+    """
+    Build the annual change products for an ARD tile, streaming chip results
+    into the outputs as they come in.
+
+    Args:
+        h: horizontal grid number
+        v: vertical grid number
+        chips: (job, results) pairs, as from runner.run, where the job
+            carries the chip upper left x/y and its shape, chips are
+            expected on the chip grid, as from planner
+        years: calendar years to produce
+        outdir: output directory
+        params: processing parameters
+
+    Returns:
+        list of output file paths
+    """
+    _, affine = ard.ard_hv(h, v, params['region-extent'])
+
+    outputs = {(product, year): create_raster(productpath(outdir, product, h, v, year),
+                                              affine, params['region-proj4'], datatype, NODATA[product])
+               for product, datatype in PRODUCTS.items()
+               for year in years}
+
+    for job, results in chips:
+        log.debug('Writing products for chip %s %s', job.x, job.y)
+
+        rowcol = ard.transform_geo(ard.GeoCoordinate(job.x, job.y), affine)
+        segs = flatten(results)
+
+        for year in years:
+            for product, arr in yearlayers(segs, year, job.shape).items():
+                write_chip(outputs[(product, year)], arr, rowcol)
+
+    paths = []
+    for (product, year), ds in outputs.items():
+        ds.FlushCache()
+        paths.append(productpath(outdir, product, h, v, year))
+
+    # Dereference to close the datasets
+    outputs.clear()
+
+    return paths
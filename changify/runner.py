@@ -0,0 +1,339 @@
+"""
+Run pyccd over many chips within a memory budget
+
+Peak memory for a chip is estimated from the tarball listing before anything
+is read, and that estimate drives how many worker processes run at once and
+how many chips each is handed at a time. Chips that would not fit in the
+budget on their own are split into sub-chips.
+"""
+import os
+import math
+import logging
+from functools import partial
+from multiprocessing import Pool
+from typing import NamedTuple, Tuple, Sequence, List, Callable
+
+import numpy as np
+
+from changify import ard, detect, planner, workqueue, aoi as aoimask
+
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class ChipJob(NamedTuple):
+    """
+    Unit of work, the upper left of a chip (or sub-chip) and its shape, along
+    with the mask of pixels to run when only part of it is in the area of
+    interest.
+    """
+    x: ard.Num
+    y: ard.Num
+    shape: Tuple[int, int]
+    mask: np.ndarray = None
+
+
+def chipbytes(nrefl: int, ntherm: int, layers: Sequence[str], dtype: str,
+              shape: Tuple[int, int]=(100, 100)) -> int:
+    """
+    Estimate the peak bytes held while building a chip's stacks.
+
+    layerstochips keeps every finished layer stack, and while a layer is being
+    stacked both the list of per-acquisition arrays and the stacked copy are
+    alive, so the largest layer counts twice.
+
+    Args:
+        nrefl: number of reflectance acquisitions
+        ntherm: number of thermal acquisitions
+        layers: layer names being extracted
+        dtype: numpy dtype the rasters are read as
+        shape: (rows, columns) of the chip
+
+    Returns:
+        int
+
+    Examples:
+        >>> chipbytes(10, 10, ['blues', 'qas'], 'int16', (2, 2))
+        240
+    """
+    pixel = shape[0] * shape[1] * np.dtype(dtype).itemsize
+    sizes = [(ntherm if layer == 'thermals' else nrefl) * pixel for layer in layers]
+
+    if not sizes:
+        return 0
+
+    return sum(sizes) + max(sizes)
+
+
+def resultbytes(nobs: int, perobs: int, shape: Tuple[int, int]=(100, 100)) -> int:
+    """
+    Estimate the bytes held by a chip's pyccd results.
+
+    Every pixel's result carries a processing mask as long as the number of
+    observations, along with its change models, and the whole list is held a
+    second time pickled while it is sent back from the worker. Both are
+    covered by a per-pixel, per-observation figure.
+
+    Args:
+        nobs: number of observations, one per reflectance acquisition
+        perobs: bytes per pixel per observation
+        shape: (rows, columns) of the chip
+
+    Returns:
+        int
+
+    Examples:
+        >>> resultbytes(10, 32, (2, 2))
+        1280
+    """
+    return shape[0] * shape[1] * nobs * perobs
+
+
+def jobbytes(job: ChipJob, nrefl: int, ntherm: int, params: dict) -> int:
+    """
+    Estimated peak bytes for a worker processing the job, including the fixed
+    per-worker overhead. The stacks are still alive while the results are
+    built, so both count.
+    """
+    return (params['worker-overhead-mb'] * MB +
+            chipbytes(nrefl, ntherm, params['file-specs'], params['chip-dtype'], job.shape) +
+            resultbytes(nrefl, params['result-bytes-per-obs'], job.shape))
+
+
+def acqcounts(job: ChipJob, params: dict) -> Tuple[int, int]:
+    """
+    Number of reflectance and thermal acquisitions the job will read, from
+    the cached tarball listing.
+    """
+    files = ard.tilefiles(ard.tileroot(ard.GeoCoordinate(job.x, job.y), params), params)
+
+    return len(files['refl_files']), len(files['therm_files'])
+
+
+def splitjob(job: ChipJob, nrefl: int, ntherm: int, params: dict) -> List[ChipJob]:
+    """
+    Split a job in half along its longer side until each piece fits in the
+    memory budget. Pieces are never split below 'min-subchip' pixels on a
+    side, a piece that still doesn't fit at that size is run as is.
+
+    Args:
+        job: chip job
+        nrefl: number of reflectance acquisitions
+        ntherm: number of thermal acquisitions
+        params: processing parameters
+
+    Returns:
+        list of ChipJob
+
+    Raises:
+        ValueError: the per-worker overhead alone exceeds the budget
+    """
+    budget = params['memory-budget-mb'] * MB
+    if params['worker-overhead-mb'] * MB >= budget:
+        raise ValueError('worker-overhead-mb ({}) leaves nothing of memory-budget-mb ({}) for chips'
+                         .format(params['worker-overhead-mb'], params['memory-budget-mb']))
+
+    rows, cols = job.shape
+
+    if jobbytes(job, nrefl, ntherm, params) <= budget:
+        return [job]
+
+    if max(rows, cols) // 2 < params['min-subchip']:
+        log.warning('Sub-chip %s %s %s is over the memory budget at the minimum size',
+                    job.x, job.y, job.shape)
+        return [job]
+
+    if rows >= cols:
+        top = rows // 2
+        halves = [ChipJob(job.x, job.y, (top, cols)),
+                  ChipJob(job.x, job.y - top * 30, (rows - top, cols))]
+    else:
+        left = cols // 2
+        halves = [ChipJob(job.x, job.y, (rows, left)),
+                  ChipJob(job.x + left * 30, job.y, (rows, cols - left))]
+
+    return [j for half in halves for j in splitjob(half, nrefl, ntherm, params)]
+
+
+def submask(mask: np.ndarray, ul: ard.GeoCoordinate, job: ChipJob) -> np.ndarray:
+    """
+    Slice a sub-chip's part out of its chip's mask.
+    """
+    row = int((ul.y - job.y) // 30)
+    col = int((job.x - ul.x) // 30)
+
+    return mask[row:row + job.shape[0], col:col + job.shape[1]]
+
+
+def plan(coords: Sequence[Tuple[ard.Num, ard.Num]], params: dict,
+         aoi: aoimask.AOI=None) -> Tuple[List[ChipJob], int, int]:
+    """
+    Turn chip coordinates into jobs and size the worker pool around the
+    memory budget.
+
+    Chips are put in planner order first, so each tile is finished before
+    the next and the contiguous batches handed to each worker stay close
+    together. Chips, and sub-chips, with no pixels inside the area of
+    interest are dropped before their tarballs are ever listed. Each chip's
+    mask is worked out once here and carried by its jobs, so the workers
+    never test the area of interest themselves.
+
+    Args:
+        coords: sequence of (x, y) coordinate pairs, one per chip
+        params: processing parameters
+        aoi: optional area of interest, raster mask path or polygon rings
+
+    Returns:
+        jobs, number of worker processes, and jobs handed to a worker at a time
+    """
+    if aoi is not None:
+        aoi = aoimask.polygons(aoi)
+
+    jobs = []
+    peak = 0
+    for x, y in planner.order(coords, params):
+        coord = ard.GeoCoordinate(x, y)
+        h, v = ard.determine_hv(coord, params['region-tileaff'])
+        _, affine = ard.ard_hv(h, v, params['region-extent'])
+        ul = ard.chipul(coord, affine)
+
+        job = ChipJob(ul.x, ul.y, (100, 100))
+        if aoi is not None:
+            mask = aoimask.chipmask(ul, aoi, job.shape)
+            if not mask.any():
+                continue
+
+        nrefl, ntherm = acqcounts(job, params)
+
+        split = splitjob(job, nrefl, ntherm, params)
+        if aoi is not None:
+            split = [j._replace(mask=submask(mask, ul, j)) for j in split]
+            split = [j for j in split if j.mask.any()]
+        if len(split) > 1:
+            log.debug('Splitting chip %s %s into %s sub-chips', x, y, len(split))
+
+        peak = max([peak] + [jobbytes(j, nrefl, ntherm, params) for j in split])
+        jobs.extend(split)
+
+    workers = max(1, min(params['memory-budget-mb'] * MB // max(peak, 1), os.cpu_count() or 1, len(jobs)))
+    batch = max(1, math.ceil(len(jobs) / (workers * 4)))
+
+    log.debug('Planned %s jobs, peak %s MB, %s workers, batch %s',
+              len(jobs), peak // MB, workers, batch)
+
+    return jobs, workers, batch
+
+
+def runjob(job: ChipJob, params: dict) -> Tuple[ChipJob, list]:
+    chips = ard.timechips(job.x, job.y, params, job.shape)
+
+    return job, detect.chipccd(chips, job.mask)
+
+
+def run(coords: Sequence[Tuple[ard.Num, ard.Num]], params: dict, aoi: aoimask.AOI=None):
+    """
+    Run pyccd over the chips, yielding (job, results) pairs as they finish.
+
+    Args:
+        coords: sequence of (x, y) coordinate pairs, one per chip
+        params: processing parameters
+        aoi: optional area of interest, only pixels inside it are run
+
+    Yields:
+        ChipJob and its list of per-pixel pyccd results, row-major, None for
+        pixels outside the area of interest
+    """
+    jobs, workers, batch = plan(coords, params, aoi)
+
+    yield from runjobs(jobs, workers, batch, params)
+
+
+def runjobs(jobs: Sequence[ChipJob], workers: int, batch: int, params: dict):
+    """
+    Run planned jobs through a worker pool sized by plan, yielding
+    (job, results) pairs as they finish.
+    """
+    with Pool(workers) as pool:
+        yield from pool.imap_unordered(partial(runjob, params=params), jobs, chunksize=batch)
+
+
+def chipunits(coords: Sequence[Tuple[ard.Num, ard.Num]], params: dict) -> List[tuple]:
+    """
+    Work queue units holding one chip each, weighted by the number of
+    acquisitions that have to be read for it.
+
+    Args:
+        coords: sequence of (x, y) chip coordinates
+        params: processing parameters
+
+    Returns:
+        list of (key, payload, weight) tuples
+    """
+    ret = []
+    for x, y in coords:
+        weight = sum(acqcounts(ChipJob(x, y, (100, 100)), params))
+        ret.append(('{}_{}'.format(x, y), {'chips': [[x, y]]}, weight))
+
+    return ret
+
+
+def tileunits(tiles: Sequence[Tuple[int, int]], params: dict) -> List[tuple]:
+    """
+    Work queue units holding a whole tile's chips, in locality order, weighted
+    by the number of acquisitions times the number of chips.
+
+    Args:
+        tiles: sequence of (h, v) tiles
+        params: processing parameters
+
+    Returns:
+        list of (key, payload, weight) tuples
+    """
+    ret = []
+    for h, v in tiles:
+        chips = planner.order(planner.tilechips(h, v, params), params)
+        weight = sum(acqcounts(ChipJob(chips[0].x, chips[0].y, (100, 100)), params)) * len(chips)
+        ret.append(('h{:02d}v{:02d}'.format(h, v), {'chips': [list(c) for c in chips]}, weight))
+
+    return ret
+
+
+def queuework(path: str, params: dict, handler: Callable, aoi: aoimask.AOI=None, owner: str=None,
+              batch: int=None) -> int:
+    """
+    Act as one node against a shared work queue, running every unit it claims
+    and passing each chip's results to the handler.
+
+    Units are claimed a batch at a time, and the chips of the whole batch are
+    planned together and go through one memory sized worker pool, as with
+    run. The pool assumes it has the whole memory budget, so start one of
+    these per node.
+
+    The default batch claims as many units as there are CPUs, so one-chip
+    units still keep every worker busy. Tile units already hold enough chips
+    to fill the pool, claim those one at a time so they stay spread across
+    nodes.
+
+    Args:
+        path: queue database path
+        params: processing parameters
+        handler: called with each (job, results) pair
+        aoi: optional area of interest
+        owner: name of this node, defaults to host:pid
+        batch: units claimed at a time, defaults to the number of CPUs
+
+    Returns:
+        number of units completed by this node
+    """
+    if aoi is not None:
+        aoi = aoimask.polygons(aoi)
+
+    def process(payloads):
+        jobs, workers, chunk = plan([c for p in payloads for c in p['chips']], params, aoi)
+
+        for job, results in runjobs(jobs, workers, chunk, params):
+            handler(job, results)
+
+    return workqueue.workbatches(path, process, batch if batch else os.cpu_count() or 1, owner)
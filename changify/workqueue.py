@@ -0,0 +1,305 @@
+"""
+File based work queue for spreading runs across nodes
+
+The queue is a SQLite database on a filesystem every node can reach, so no
+broker is needed. Nodes claim units inside an immediate transaction, which
+makes a claim atomic, and hold them on a lease that has to be renewed while
+they work. Units whose lease runs out, because a node died or hung, go back
+to pending for someone else to pick up, until they run out of attempts.
+Heaviest units are handed out first so the long ones don't end up trailing
+at the end of a run.
+
+Lease expiry is judged against each node's clock, so node clocks need to be
+reasonably in sync.
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from typing import NamedTuple, Iterable, Sequence, Tuple, Callable
+
+from changify import app
+
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS units (
+    key TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    weight REAL NOT NULL DEFAULT 1,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS units_state_weight ON units (state, weight);
+'''
+
+
+class WorkUnit(NamedTuple):
+    """
+    A claimed unit of work.
+    """
+    key: str
+    payload: object
+    weight: float
+    attempts: int
+
+
+def defaultowner() -> str:
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    Open the queue database, creating the table if needed. Transactions are
+    managed explicitly.
+    """
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def enqueue(conn: sqlite3.Connection, units: Iterable[Tuple[str, object, float]]) -> int:
+    """
+    Add units to the queue, units already present are left alone.
+
+    Args:
+        conn: queue connection
+        units: (key, payload, weight) tuples, payloads must be JSON serializable
+
+    Returns:
+        number of units added
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        cur = conn.executemany('INSERT OR IGNORE INTO units (key, payload, weight) VALUES (?, ?, ?)',
+                               ((k, json.dumps(p), w) for k, p, w in units))
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+    return cur.rowcount
+
+
+def claim(conn: sqlite3.Connection, owner: str, lease: float, maxattempts: int) -> WorkUnit:
+    """
+    Atomically claim the heaviest pending unit, first returning any units
+    with expired leases to pending.
+
+    A unit whose lease expired after its last allowed attempt is failed
+    instead, so a unit that keeps killing the node working it, e.g. by
+    running it out of memory, isn't handed out forever.
+
+    Args:
+        conn: queue connection
+        owner: name of the claiming node/process
+        lease: seconds the claim is good for without renewal
+        maxattempts: attempts before a unit is failed
+
+    Returns:
+        WorkUnit, or None when nothing is left to claim
+    """
+    now = time.time()
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        reclaimed = conn.execute("UPDATE units SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                                 "owner = NULL, expires = NULL "
+                                 "WHERE state = 'leased' AND expires < ?", (maxattempts, now)).rowcount
+        if reclaimed:
+            log.debug('Reclaimed %s expired leases', reclaimed)
+
+        row = conn.execute("SELECT key, payload, weight, attempts FROM units "
+                           "WHERE state = 'pending' ORDER BY weight DESC, key LIMIT 1").fetchone()
+
+        if row is not None:
+            conn.execute("UPDATE units SET state = 'leased', owner = ?, expires = ?, attempts = attempts + 1 "
+                         "WHERE key = ?", (owner, now + lease, row[0]))
+
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+    if row is None:
+        return None
+
+    return WorkUnit(row[0], json.loads(row[1]), row[2], row[3] + 1)
+
+
+def _settle(conn: sqlite3.Connection, sql: str, args: tuple) -> bool:
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        count = conn.execute(sql, args).rowcount
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+    return count == 1
+
+
+def renew(conn: sqlite3.Connection, key: str, owner: str, lease: float) -> bool:
+    """
+    Extend a lease, False if the unit is no longer held by the owner.
+    """
+    return _settle(conn,
+                   "UPDATE units SET expires = ? WHERE key = ? AND owner = ? AND state = 'leased'",
+                   (time.time() + lease, key, owner))
+
+
+def complete(conn: sqlite3.Connection, key: str, owner: str) -> bool:
+    """
+    Mark a unit done, False if the unit is no longer held by the owner.
+    """
+    return _settle(conn,
+                   "UPDATE units SET state = 'done', expires = NULL WHERE key = ? AND owner = ? AND state = 'leased'",
+                   (key, owner))
+
+
+def release(conn: sqlite3.Connection, key: str, owner: str, maxattempts: int) -> bool:
+    """
+    Give up a unit after a failure, back to pending, or to failed once it has
+    used up its attempts.
+    """
+    return _settle(conn,
+                   "UPDATE units SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                   "owner = NULL, expires = NULL WHERE key = ? AND owner = ? AND state = 'leased'",
+                   (maxattempts, key, owner))
+
+
+def counts(conn: sqlite3.Connection) -> dict:
+    """
+    Number of units in each state.
+    """
+    return dict(conn.execute('SELECT state, COUNT(*) FROM units GROUP BY state').fetchall())
+
+
+class Heartbeat(threading.Thread):
+    """
+    Keeps renewing leases in the background while units are worked on.
+    """
+    def __init__(self, path: str, keys: Sequence[str], owner: str, lease: float):
+        super().__init__(daemon=True)
+        self.path = path
+        self.keys = list(keys)
+        self.owner = owner
+        self.lease = lease
+        self.done = threading.Event()
+
+    def run(self):
+        conn = connect(self.path)
+        try:
+            while self.keys and not self.done.wait(self.lease / 3):
+                for key in list(self.keys):
+                    if not renew(conn, key, self.owner, self.lease):
+                        log.warning('Lost lease on %s', key)
+                        self.keys.remove(key)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+
+def work(path: str, func: Callable, owner: str=None, lease: float=None, maxattempts: int=None,
+         wait: bool=True, poll: float=None) -> int:
+    """
+    Claim and process units one at a time until the queue has nothing left
+    to hand out.
+
+    Args:
+        path: queue database path
+        func: called with each unit's payload
+        owner: name of this worker, defaults to host:pid
+        lease: lease length in seconds, defaults to 'queue-lease-seconds'
+        maxattempts: attempts before a unit is failed, defaults to
+            'queue-max-attempts'
+        wait: keep polling while other workers hold leases
+        poll: seconds between polls, defaults to 'queue-poll-seconds'
+
+    Returns:
+        number of units completed by this worker
+    """
+    return workbatches(path, lambda payloads: func(payloads[0]), 1, owner, lease, maxattempts, wait, poll)
+
+
+def workbatches(path: str, func: Callable, batch: int, owner: str=None, lease: float=None,
+                maxattempts: int=None, wait: bool=True, poll: float=None) -> int:
+    """
+    Claim and process up to batch units at a time until the queue has nothing
+    left to hand out.
+
+    With wait, a worker that runs out of pending units sticks around while
+    other workers still hold leases, so it can pick up after any of them that
+    die. A failed batch releases all of its units.
+
+    Args:
+        path: queue database path
+        func: called with the list of payloads of each batch of claimed units
+        batch: most units claimed at a time
+        owner: name of this worker, defaults to host:pid
+        lease: lease length in seconds, defaults to 'queue-lease-seconds'
+        maxattempts: attempts before a unit is failed, defaults to
+            'queue-max-attempts'
+        wait: keep polling while other workers hold leases
+        poll: seconds between polls, defaults to 'queue-poll-seconds'
+
+    Returns:
+        number of units completed by this worker
+    """
+    owner = owner if owner else defaultowner()
+    lease = lease if lease else app.Config['queue-lease-seconds']
+    maxattempts = maxattempts if maxattempts else app.Config['queue-max-attempts']
+    poll = poll if poll else app.Config['queue-poll-seconds']
+
+    conn = connect(path)
+    done = 0
+    try:
+        while True:
+            units = []
+            while len(units) < batch:
+                unit = claim(conn, owner, lease, maxattempts)
+                if unit is None:
+                    break
+                units.append(unit)
+
+            if not units:
+                if not wait or not counts(conn).get('leased'):
+                    break
+
+                time.sleep(poll)
+                continue
+
+            keys = [u.key for u in units]
+            log.debug('%s claimed %s', owner, ', '.join('{} attempt {}'.format(u.key, u.attempts) for u in units))
+
+            beat = Heartbeat(path, keys, owner, lease)
+            beat.start()
+            try:
+                func([u.payload for u in units])
+            except Exception:
+                log.exception('Units %s failed', ', '.join(keys))
+                for key in keys:
+                    release(conn, key, owner, maxattempts)
+                continue
+            finally:
+                beat.stop()
+
+            for key in keys:
+                if complete(conn, key, owner):
+                    done += 1
+                else:
+                    log.warning('%s finished %s after losing its lease', owner, key)
+    finally:
+        conn.close()
+
+    return done
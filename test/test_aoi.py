@@ -0,0 +1,64 @@
+import numpy as np
+
+from changify import ard, aoi
+
+
+tst_ul = ard.GeoCoordinate(-1815585, 3014805)
+
+# Covers the western half of the chip at tst_ul, with a hole in its corner
+tst_rings = [[(-1815585, 3014805), (-1814085, 3014805), (-1814085, 3011805), (-1815585, 3011805)],
+             [(-1815585, 3014805), (-1815285, 3014805), (-1815285, 3014505), (-1815585, 3014505)]]
+
+
+def test_inpolygon():
+    square = [[(0, 0), (10, 0), (10, 10), (0, 10)]]
+    xs = np.array([5, 15, -1, 9.9])
+    ys = np.array([5, 5, 5, 0.1])
+
+    assert np.array_equal(aoi.inpolygon(xs, ys, square), [True, False, False, True])
+
+
+def test_inpolygon_edges():
+    # Many sided ring, mostly well away from the points, against a plain
+    # crossing count over every edge
+    angles = np.linspace(0, 2 * np.pi, 2000, endpoint=False)
+    radii = 50 + 10 * np.sin(7 * angles)
+    ring = np.column_stack([radii * np.cos(angles), radii * np.sin(angles)])
+    xs, ys = np.meshgrid(np.arange(35.5, 65), np.arange(-14.5, 15))
+
+    expected = np.zeros(xs.shape, dtype=bool)
+    for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis=0)):
+        expected ^= ((y1 > ys) != (y2 > ys)) & (xs < x1 + (ys - y1) * (x2 - x1) / (y2 - y1))
+
+    assert expected.any() and not expected.all()
+    assert np.array_equal(aoi.inpolygon(xs, ys, [ring]), expected)
+
+
+def test_polygons():
+    polys = aoi.polygons(tst_rings)
+
+    assert polys.extent == ard.GeoExtent(-1815585, 3014805, -1814085, 3011805)
+    assert aoi.polygons(polys) is polys
+    assert aoi.polygons('mask.tif') == 'mask.tif'
+    assert np.array_equal(aoi.chipmask(tst_ul, polys), aoi.chipmask(tst_ul, tst_rings))
+
+
+def test_chipmask():
+    mask = aoi.chipmask(tst_ul, tst_rings)
+
+    assert mask.shape == (100, 100)
+    assert mask.sum() == 100 * 50 - 10 * 10
+    assert not mask[:10, :10].any()
+    assert not mask[:, 50:].any()
+
+
+def test_prunechips():
+    chips = [tst_ul, (tst_ul.x + 3000, tst_ul.y), (tst_ul.x, tst_ul.y - 3000)]
+
+    assert aoi.prunechips(chips, tst_rings) == [tst_ul]
+
+
+def test_prunetiles():
+    extent = ard.GeoExtent(-2565585, 3314805, 2384415, 14805)
+
+    assert aoi.prunetiles([(5, 2), (6, 2), (5, 3)], tst_rings, {'region-extent': extent}) == [(5, 2)]
@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 
 from changify import ard, app
@@ -125,3 +127,77 @@ def test_tarfiles():
 
     assert sorted(files) == ['LE07_CU_005002_19991020_20170712_C01_V01_SR.tar',
                              'LT05_CU_005002_19850302_20170711_C01_V01_SR.tar']
+
+
+def test_pointwindows():
+    rcs = [ard.RowColumn(0, 0), ard.RowColumn(2, 3), ard.RowColumn(0, 99), ard.RowColumn(150, 150)]
+    windows = ard.pointwindows(rcs, 4)
+
+    assert windows == [(ard.RowColumnExtent(0, 0, 1, 1), [0]),
+                       (ard.RowColumnExtent(2, 3, 3, 4), [1]),
+                       (ard.RowColumnExtent(0, 99, 1, 100), [2]),
+                       (ard.RowColumnExtent(150, 150, 151, 151), [3])]
+
+    windows = ard.pointwindows(rcs[:2], 6)
+
+    assert windows == [(ard.RowColumnExtent(0, 0, 3, 4), [0, 1])]
+
+
+def test_readpoints():
+    path = ard.vsipath(r'test/data/h05v02/LT05_CU_005002_19850302_20170711_C01_V01_BT.tar',
+                       'thermals',
+                       config['file-specs'],
+                       'BT')
+    rcs = [ard.RowColumn(300, 3800), ard.RowColumn(302, 3805), ard.RowColumn(4000, 10)]
+    expected = [ard.extract_rcextent(path, ard.RowColumnExtent(rc.row, rc.column, rc.row + 1, rc.column + 1))[0, 0]
+                for rc in rcs]
+
+    assert np.array_equal(ard.readpoints(path, rcs, ard.pointwindows(rcs, 1)), expected)
+    assert np.array_equal(ard.readpoints(path, rcs, ard.pointwindows(rcs, 16)), expected)
+
+
+def test_layerstochips_threaded():
+    root = r'test/data/h05v02'
+    files = sorted(f for f in ard.dirlisting(root) if f.endswith('BT.tar'))
+    layers = {'thermals': [ard.vsipath(os.path.join(root, f), 'thermals', config['file-specs'], 'BT')
+                           for f in files]}
+    params = {'region-tileaff': config['conus-tileaff'],
+              'region-extent': ard.GeoExtent(**config['conus-extent'])}
+
+    # No 'threads' given reads serially
+    serial = ard.layerstochips(tst_coord, layers, params)
+    params['threads'] = 4
+    threaded = ard.layerstochips(tst_coord, layers, params)
+
+    assert threaded['thermals'].dtype == serial['thermals'].dtype
+    assert np.array_equal(threaded['thermals'], serial['thermals'])
+
+
+def test_pointseries():
+    params = {'region-tileaff': config['conus-tileaff'],
+              'region-extent': ard.GeoExtent(**config['conus-extent']),
+              'file-root': 'test/data',
+              'acquired': '1980-01-01/2016-01-01',
+              'region': 'CU',
+              'refl': 'QA',
+              'file-specs': {k: config['file-specs'][k] for k in ('thermals', 'qas')},
+              'point-window-ratio': 16}
+    # Out of order, with a duplicate, close neighbors and a far away point
+    points = [(-1701105, 3005565), (-1701195, 3005565), (-1780000, 2900000),
+              (-1701195, 3005565), (-1701165, 3005535)]
+
+    series = ard.pointseries(points, params)
+
+    hvroot = ard.tileroot(tst_coord, params)
+    files = ard.tilefiles(hvroot, params)
+    layers = ard.layersdict(files, hvroot, params)
+    _, aff = ard.ard_hv(5, 2, params['region-extent'])
+
+    assert len(series) == len(points)
+    for point, ret in zip(points, series):
+        rc = ard.transform_geo(ard.GeoCoordinate(*point), aff)
+        ext = ard.RowColumnExtent(rc.row, rc.column, rc.row + 1, rc.column + 1)
+
+        assert np.array_equal(ret['dates'], [19850302, 19991020, 20150314])
+        for layer, paths in layers.items():
+            assert np.array_equal(ret[layer], [ard.extract_rcextent(p, ext)[0, 0] for p in paths])
@@ -0,0 +1,55 @@
+from changify import cache
+
+
+def test_lrucache_maxsize():
+    c = cache.LRUCache('tst', maxsize=2)
+    c.put('a', 1)
+    c.put('b', 2)
+    c.get('a')
+    c.put('c', 3)
+
+    assert c.get('b') is None
+    assert c.get('a') == 1
+    assert c.stats() == cache.CacheStats('tst', 2, 1, 1, 2, 0, 2, None)
+
+
+def test_lrucache_maxbytes():
+    c = cache.LRUCache('tst', maxbytes=5, weigher=len)
+    c.put('a', [1, 2, 3])
+    c.put('b', [1, 2])
+    c.put('c', [1])
+
+    assert c.get('a') is None
+    assert c.stats().nbytes == 3
+
+    # An oversized entry is still held on its own
+    c.put('d', list(range(10)))
+
+    assert c.get('d') == list(range(10))
+    assert c.stats().size == 1
+
+
+def test_cached():
+    calls = []
+
+    @cache.cached('tst_cached')
+    def func(x):
+        calls.append(x)
+        return x * 2
+
+    assert func(2) == 4
+    assert func(2) == 4
+    assert calls == [2]
+    assert cache.stats()['tst_cached'].hits == 1
+
+    cache.clear(['tst_cached'])
+    func(2)
+
+    assert calls == [2, 2]
+
+
+def test_bounds(monkeypatch):
+    monkeypatch.setenv('CHANGIFY_CACHE_TARFILES_MAXSIZE', '10')
+
+    assert cache.bounds('tarfiles') == (10, 67108864)
+    assert cache.bounds('nonexistent') == (None, None)
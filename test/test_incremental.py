@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+
+from changify import incremental, ard, app
+
+
+config = app.Config
+
+
+tst_files = {'refl_files': ['LT05_CU_005002_19850302_20170711_C01_V01_SR.tar',
+                            'LE07_CU_005002_19991020_20170712_C01_V01_SR.tar',
+                            'LC08_CU_005002_20150314_20170713_C01_V01_SR.tar'],
+             'therm_files': ['LT05_CU_005002_19850302_20170711_C01_V01_BT.tar',
+                             'LE07_CU_005002_19991020_20170712_C01_V01_BT.tar',
+                             'LC08_CU_005002_20150314_20170713_C01_V01_BT.tar']}
+
+
+def test_lastdate():
+    chips = {'dates': np.array([19850302, 19991020])}
+
+    assert incremental.lastdate(chips) == 19991020
+    assert incremental.lastdate({'dates': np.array([])}) == 0
+    assert incremental.lastdate(None) == 0
+
+
+def test_newfiles():
+    fresh = incremental.newfiles(tst_files, 19991020)
+
+    assert fresh == {'refl_files': ['LC08_CU_005002_20150314_20170713_C01_V01_SR.tar'],
+                     'therm_files': ['LC08_CU_005002_20150314_20170713_C01_V01_BT.tar']}
+
+
+def test_appendchips():
+    chips = {'qas': np.zeros((2, 3, 3)), 'dates': np.array([1, 2])}
+    new = {'qas': np.ones((1, 3, 3)), 'dates': np.array([3])}
+
+    ret = incremental.appendchips(chips, new)
+
+    assert ret['qas'].shape == (3, 3, 3)
+    assert np.array_equal(ret['dates'], [1, 2, 3])
+
+
+def test_affected():
+    qas = np.full((2, 2, 2), 1)
+    qas[1, 0, 0] = 2
+    qas[0, 1, 1] = 4
+
+    ret = incremental.affected({'qas': qas}, {'qa-usable-bits': [1, 2]})
+
+    assert np.array_equal(ret, [[True, False], [False, True]])
+
+
+def test_savechips(tmpdir):
+    params = {'region-tileaff': config['conus-tileaff'],
+              'region-extent': ard.GeoExtent(**config['conus-extent']),
+              'state-root': str(tmpdir),
+              'segment-limit': 8}
+    coord = ard.GeoCoordinate(-1701195, 3005565)
+
+    assert incremental.loadchips(coord, params) is None
+    assert incremental.storeddate(coord, params) == 0
+
+    incremental.savechips(coord, {'qas': np.zeros((2, 3, 3)), 'dates': np.array([19850302, 19991020])}, params)
+    incremental.savechips(coord, {'qas': np.ones((1, 3, 3)), 'dates': np.array([20150314])}, params)
+
+    chips = incremental.loadchips(coord, params)
+
+    assert incremental.storeddate(coord, params) == 20150314
+    assert np.array_equal(chips['dates'], [19850302, 19991020, 20150314])
+    assert chips['qas'].shape == (3, 3, 3)
+    assert len(tmpdir.listdir()[0].listdir()) == 2
+
+
+def test_compact(tmpdir):
+    params = {'region-tileaff': config['conus-tileaff'],
+              'region-extent': ard.GeoExtent(**config['conus-extent']),
+              'state-root': str(tmpdir),
+              'segment-limit': 2}
+    coord = ard.GeoCoordinate(-1701195, 3005565)
+
+    for date in [19850302, 19991020, 20150314]:
+        incremental.savechips(coord, {'qas': np.full((1, 3, 3), date), 'dates': np.array([date])}, params)
+
+    segs = incremental.segments(coord, params)
+    chips = incremental.loadchips(coord, params)
+
+    assert [os.path.basename(s) for s in segs] == ['chips_20150314.npz']
+    assert np.array_equal(chips['dates'], [19850302, 19991020, 20150314])
+    assert np.array_equal(chips['qas'][:, 0, 0], chips['dates'])
+
+    # A merge interrupted after the merged segment was written, but before
+    # the old one was removed
+    incremental.savechips(coord, {'qas': np.ones((1, 3, 3)), 'dates': np.array([20170101])}, params)
+    merged = {'qas': np.ones((4, 3, 3)), 'dates': np.array([19850302, 19991020, 20150314, 20170101])}
+    np.savez(incremental.segments(coord, params)[-1], **merged)
+
+    assert len(incremental.segments(coord, params)) == 2
+    assert np.array_equal(incremental.loadchips(coord, params)['dates'], merged['dates'])
@@ -0,0 +1,64 @@
+import random
+
+from changify import ard, app, planner
+
+
+config = app.Config
+
+tst_params = {'region-extent': ard.GeoExtent(**config['conus-extent']),
+              'region-tileaff': config['conus-tileaff'],
+              'region-chipaff': config['conus-chipaff']}
+
+
+def test_hilbert():
+    n = 8
+    cells = sorted(((x, y) for x in range(n) for y in range(n)),
+                   key=lambda c: planner.hilbert(n, *c))
+
+    assert sorted(planner.hilbert(n, *c) for c in cells) == list(range(n * n))
+    # Consecutive cells along the curve are always neighbors
+    assert all(abs(a[0] - b[0]) + abs(a[1] - b[1]) == 1 for a, b in zip(cells, cells[1:]))
+
+
+def test_zorder():
+    assert sorted(planner.zorder(4, x, y) for x in range(4) for y in range(4)) == list(range(16))
+    assert planner.zorder(4, 3, 3) == 15
+
+
+def test_tilechips():
+    chips = planner.tilechips(5, 2, tst_params)
+
+    assert len(chips) == 2500
+    assert chips[0] == (-1815585, 3014805)
+    assert all(ard.determine_hv(c, tst_params['region-tileaff']) == (5, 2) for c in chips)
+
+
+def test_regionchips():
+    ext = ard.GeoExtent(-1815585, 3014805, -1809585, 3008805)
+
+    assert len(planner.regionchips(ext, tst_params)) == 4
+
+
+def test_pointchips():
+    chips = planner.pointchips([(-1815580, 3014800), (-1815500, 3014700), (-1812580, 3014800)], tst_params)
+
+    assert sorted(chips) == [(-1815585, 3014805), (-1812585, 3014805)]
+
+
+def test_order():
+    chips = planner.tilechips(5, 2, tst_params) + planner.tilechips(6, 2, tst_params)
+    random.Random(0).shuffle(chips)
+
+    ordered = planner.order(chips, tst_params)
+
+    assert sorted(ordered) == sorted(chips)
+    assert planner.tilevisits(chips, tst_params) > 2
+    assert planner.tilevisits(ordered, tst_params) == 2
+
+    for run in planner.runs(ordered, 3):
+        assert planner.tilevisits(run, tst_params) <= 2
+
+
+def test_runs():
+    assert planner.runs(list(range(7)), 3) == [[0, 1, 2], [3, 4], [5, 6]]
+    assert planner.runs([1], 2) == [[1], []]
@@ -0,0 +1,52 @@
+import datetime as dt
+
+import numpy as np
+
+from changify import products
+
+
+def tst_model(start, end, brk, prob, qa=8, mag=1):
+    seg = {'start_day': dt.date(*start).toordinal(),
+           'end_day': dt.date(*end).toordinal(),
+           'break_day': dt.date(*brk).toordinal(),
+           'change_probability': prob,
+           'curve_qa': qa}
+    seg.update({b: {'magnitude': mag} for b in products.MAG_BANDS})
+
+    return seg
+
+
+tst_results = [{'change_models': [tst_model((2000, 1, 1), (2005, 3, 1), (2005, 3, 10), 1, 8, 2),
+                                  tst_model((2005, 3, 10), (2010, 1, 1), (2010, 1, 1), 0, 4)]},
+               {'change_models': [tst_model((2000, 1, 1), (2010, 1, 1), (2010, 1, 1), 0, 8)]},
+               None,
+               {'change_models': []}]
+
+
+def test_flatten():
+    segs = products.flatten(tst_results)
+
+    assert segs['valid'].shape == (4, 2)
+    assert np.array_equal(segs['valid'], [[True, True], [True, False], [False, False], [False, False]])
+    assert np.isclose(segs['mag'][0, 0], np.sqrt(5 * 4))
+    assert np.array_equal(segs['ran'], [True, True, False, True])
+
+
+def test_yearlayers():
+    segs = products.flatten(tst_results)
+
+    layers = products.yearlayers(segs, 2005, (2, 2))
+
+    assert np.array_equal(layers['changeday'], [[69, 0], [65535, 0]])
+    assert np.allclose(layers['changemag'], [[np.sqrt(20), 0], [-9999, 0]])
+    assert np.array_equal(layers['segcount'], [[2, 1], [255, 0]])
+    assert np.array_equal(layers['modelqa'], [[4, 8], [255, 0]])
+    assert all(layers[p].dtype == a.dtype for p, a in layers.items()
+               for a in [products.yearlayers(segs, 2003, (2, 2))[p]])
+
+    layers = products.yearlayers(segs, 2003, (2, 2))
+
+    assert np.array_equal(layers['changeday'], [[0, 0], [65535, 0]])
+    assert np.array_equal(layers['segcount'], [[1, 1], [255, 0]])
+    assert np.array_equal(layers['modelqa'], [[8, 8], [255, 0]])
+    assert layers['changeday'].dtype == np.uint16
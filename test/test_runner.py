@@ -0,0 +1,157 @@
+import pickle
+import random
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from changify import ard, runner, planner, app
+
+
+config = app.Config
+
+tst_layers = ['blues', 'thermals', 'qas']
+
+
+def test_chipbytes():
+    assert runner.chipbytes(10, 5, tst_layers, 'int16', (2, 2)) == (80 + 40 + 80) + 80
+    assert runner.chipbytes(10, 5, tst_layers, 'float64', (2, 2)) == 4 * 280
+    assert runner.chipbytes(10, 5, [], 'int16') == 0
+
+
+def tst_result(nobs, nsegs, rand):
+    """
+    Stand-in for a pyccd result, with the same layout.
+    """
+    def model():
+        seg = {'start_day': 723000 + rand.randint(0, 9999),
+               'end_day': 733000 + rand.randint(0, 9999),
+               'break_day': 733000 + rand.randint(0, 9999),
+               'observation_count': rand.randint(12, nobs),
+               'change_probability': rand.random(),
+               'curve_qa': 8}
+        seg.update({b: {'magnitude': rand.random(),
+                        'rmse': rand.random(),
+                        'coefficients': tuple(rand.random() for _ in range(7)),
+                        'intercept': rand.random()}
+                    for b in ('blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'thermal')})
+        return seg
+
+    return {'algorithm': 'lcmap-pyccd',
+            'processing_mask': [rand.randint(0, 1) for _ in range(nobs)],
+            'procedure': 'standard_procedure',
+            'change_models': [model() for _ in range(nsegs)]}
+
+
+def test_resultbytes():
+    nobs, shape = 1500, (4, 4)
+    rand = random.Random(0)
+
+    # Results for a chip and their pickled copy, as held by a worker
+    tracemalloc.start()
+    results = [tst_result(nobs, 5, rand) for _ in range(shape[0] * shape[1])]
+    pickled = pickle.dumps(results)
+    measured, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    estimate = runner.resultbytes(nobs, config['result-bytes-per-obs'], shape)
+
+    assert measured <= estimate <= 1.5 * measured
+    assert len(pickled) < estimate
+
+
+def test_splitjob():
+    params = {'file-specs': tst_layers,
+              'chip-dtype': 'int16',
+              'worker-overhead-mb': 0,
+              'result-bytes-per-obs': 0,
+              'memory-budget-mb': 1,
+              'min-subchip': 10}
+    job = runner.ChipJob(-1815585, 3014805, (100, 100))
+
+    # 100 acquisitions -> 8,000,000 bytes for the full chip, needs 8 pieces
+    jobs = runner.splitjob(job, 100, 100, params)
+
+    assert len(jobs) == 8
+    assert sum(j.shape[0] * j.shape[1] for j in jobs) == 100 * 100
+    assert jobs[0] == runner.ChipJob(-1815585, 3014805, (25, 50))
+    assert jobs[-1] == runner.ChipJob(-1815585 + 50 * 30, 3014805 - 75 * 30, (25, 50))
+
+    assert runner.splitjob(job, 1, 1, params) == [job]
+
+    # Far too many acquisitions to ever fit, splitting stops at the minimum size
+    jobs = runner.splitjob(job, 100000, 100000, params)
+
+    assert len(jobs) == 64
+    assert all(min(j.shape) >= 10 for j in jobs)
+
+    params['worker-overhead-mb'] = 1
+
+    with pytest.raises(ValueError):
+        runner.splitjob(job, 1, 1, params)
+
+
+def test_chipunits():
+    params = {'region-tileaff': config['conus-tileaff'],
+              'file-root': 'test/data',
+              'acquired': '1980-01-01/2014-01-01',
+              'region': 'CU',
+              'refl': 'QA'}
+
+    units = runner.chipunits([(-1701195, 3005565)], params)
+
+    assert units == [('-1701195_3005565', {'chips': [[-1701195, 3005565]]}, 4)]
+
+
+def test_plan_order():
+    params = dict(config)
+    params.update({'region-tileaff': config['conus-tileaff'],
+                   'region-chipaff': config['conus-chipaff'],
+                   'region-extent': ard.GeoExtent(**config['conus-extent']),
+                   'file-root': 'test/data',
+                   'region': 'CU',
+                   'refl': 'QA'})
+    coords = [(-1815585 + 3000 * col, 3014805 - 3000 * row) for row in range(4) for col in range(4)]
+    random.Random(0).shuffle(coords)
+
+    jobs, workers, batch = runner.plan(coords, params)
+
+    assert [(j.x, j.y) for j in jobs] == planner.order(coords, params)
+    assert 1 <= workers <= len(jobs) and batch >= 1
+
+    # A lone chip never gets a pool bigger than its one job
+    assert runner.plan(coords[:1], params)[1] == 1
+
+
+def test_plan_aoi():
+    params = dict(config)
+    params.update({'region-tileaff': config['conus-tileaff'],
+                   'region-chipaff': config['conus-chipaff'],
+                   'region-extent': ard.GeoExtent(**config['conus-extent']),
+                   'file-root': 'test/data',
+                   'region': 'CU',
+                   'refl': 'QA'})
+    ul = (-1815585, 3014805)
+    # Western half of the first chip
+    rings = [[ul, (ul[0] + 1500, ul[1]), (ul[0] + 1500, ul[1] - 3000), (ul[0], ul[1] - 3000)]]
+
+    jobs, workers, _ = runner.plan([ul, (ul[0] + 3000, ul[1])], params, rings)
+
+    assert len(jobs) == 1 and workers == 1
+    assert jobs[0].mask.shape == (100, 100)
+    assert jobs[0].mask[:, :50].all() and not jobs[0].mask[:, 50:].any()
+
+    # Sub-chips get their slice of the chip's mask, those outside are dropped
+    params.update({'memory-budget-mb': 1, 'worker-overhead-mb': 0, 'result-bytes-per-obs': 100})
+    jobs, _, _ = runner.plan([ul], params, rings)
+
+    assert all(j.mask.shape == j.shape and j.mask.all() for j in jobs)
+    assert sum(j.mask.sum() for j in jobs) == 100 * 50
+
+
+def test_submask():
+    mask = np.arange(100 * 100).reshape(100, 100)
+    ul = ard.GeoCoordinate(-1815585, 3014805)
+    job = runner.ChipJob(ul.x + 50 * 30, ul.y - 25 * 30, (25, 50))
+
+    assert np.array_equal(runner.submask(mask, ul, job), mask[25:50, 50:])
@@ -0,0 +1,129 @@
+import os
+import multiprocessing as mp
+
+import pytest
+
+from changify import workqueue
+
+
+tst_units = [('a', {'n': 1}, 1), ('b', {'n': 2}, 5), ('c', {'n': 3}, 3)]
+
+
+def record(outdir, payload):
+    with open(os.path.join(outdir, str(os.getpid())), 'a') as f:
+        f.write('{}\n'.format(payload['n']))
+
+
+def worker(path, outdir):
+    workqueue.work(path, lambda p: record(outdir, p), lease=30, maxattempts=1, poll=0.1)
+
+
+def test_claim_order(tmpdir):
+    conn = workqueue.connect(str(tmpdir.join('queue.db')))
+
+    assert workqueue.enqueue(conn, tst_units) == 3
+    assert workqueue.enqueue(conn, tst_units) == 0
+
+    claimed = [workqueue.claim(conn, 'tst', 30, 3).key for _ in range(3)]
+
+    assert claimed == ['b', 'c', 'a']
+    assert workqueue.claim(conn, 'tst', 30, 3) is None
+    assert workqueue.counts(conn) == {'leased': 3}
+
+
+def test_lease_expiry(tmpdir):
+    conn = workqueue.connect(str(tmpdir.join('queue.db')))
+    workqueue.enqueue(conn, tst_units[:1])
+
+    unit = workqueue.claim(conn, 'node1', -1, 3)
+
+    # node1's lease has already run out, so node2 picks the unit up
+    unit2 = workqueue.claim(conn, 'node2', 30, 3)
+
+    assert unit2.key == unit.key
+    assert unit2.attempts == 2
+    assert workqueue.complete(conn, unit.key, 'node1') is False
+    assert workqueue.renew(conn, unit.key, 'node1', 30) is False
+    assert workqueue.complete(conn, unit.key, 'node2') is True
+    assert workqueue.counts(conn) == {'done': 1}
+
+
+def test_release(tmpdir):
+    conn = workqueue.connect(str(tmpdir.join('queue.db')))
+    workqueue.enqueue(conn, tst_units[:1])
+
+    workqueue.release(conn, workqueue.claim(conn, 'tst', 30, 3).key, 'tst', 2)
+    assert workqueue.counts(conn) == {'pending': 1}
+
+    workqueue.release(conn, workqueue.claim(conn, 'tst', 30, 3).key, 'tst', 2)
+    assert workqueue.counts(conn) == {'failed': 1}
+
+
+def test_work_processes(tmpdir):
+    path = str(tmpdir.join('queue.db'))
+    outdir = tmpdir.mkdir('out')
+
+    conn = workqueue.connect(path)
+    workqueue.enqueue(conn, [(str(n), {'n': n}, n) for n in range(50)])
+
+    procs = [mp.Process(target=worker, args=(path, str(outdir))) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    done = []
+    for f in outdir.listdir():
+        done.extend(int(n) for n in f.read().split())
+
+    assert sorted(done) == list(range(50))
+    assert workqueue.counts(conn) == {'done': 50}
+
+
+def test_workbatches(tmpdir):
+    path = str(tmpdir.join('queue.db'))
+    conn = workqueue.connect(path)
+    workqueue.enqueue(conn, [(str(n), {'n': n}, n) for n in range(5)])
+
+    batches = []
+
+    def fail(payloads):
+        batches.append([p['n'] for p in payloads])
+        if len(batches) == 1:
+            raise ValueError
+
+    assert workqueue.workbatches(path, fail, 2, lease=30, maxattempts=2, poll=0.1) == 5
+
+    # The failed first batch is released whole and claimed again
+    assert batches == [[4, 3], [4, 3], [2, 1], [0]]
+    assert workqueue.counts(conn) == {'done': 5}
+
+
+def test_work_interrupt(tmpdir):
+    path = str(tmpdir.join('queue.db'))
+    conn = workqueue.connect(path)
+    workqueue.enqueue(conn, tst_units[:2])
+
+    calls = []
+
+    def interrupt(payload):
+        calls.append(payload)
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        workqueue.work(path, interrupt, lease=30, maxattempts=1, poll=0.1)
+
+    assert len(calls) == 1
+    assert workqueue.counts(conn) == {'leased': 1, 'pending': 1}
+
+
+def test_lease_expiry_attempts(tmpdir):
+    conn = workqueue.connect(str(tmpdir.join('queue.db')))
+    workqueue.enqueue(conn, tst_units[:1])
+
+    # Every claim dies without settling, as if the node was killed
+    for _ in range(3):
+        assert workqueue.claim(conn, 'tst', -1, 3) is not None
+
+    assert workqueue.claim(conn, 'tst', -1, 3) is None
+    assert workqueue.counts(conn) == {'failed': 1}